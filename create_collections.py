@@ -10,20 +10,46 @@ This script creates three collections:
 Run this script after setting up your .env file with H2OGPTE_API_KEY.
 """
 
+import asyncio
 import os
+import re
+from pathlib import Path
 
-from dotenv import load_dotenv
-from h2ogpte import H2OGPTE
+from h2ogpte import H2OGPTEAsync
+
+from src.agent._env import ensure_env
 
 # Load environment variables
-load_dotenv()
+ensure_env()
+
+# Number of documents uploaded at the same time
+UPLOAD_CONCURRENCY = 4
+
+# Collection ID assignments rewritten in .env
+ENV_COLLECTION_ID_PATTERN = re.compile(
+    r"^(POLICY_COLLECTION_ID|ENTITY_COLLECTION_ID|MARKET_COLLECTION_ID)=.*$",
+    re.MULTILINE
+)
+
+
+async def _upload_one(client: H2OGPTEAsync, semaphore: asyncio.Semaphore, doc_path: str) -> str:
+    """Upload a single document, bounded by the shared semaphore."""
+    async with semaphore:
+        print(f"   📄 Uploading: {doc_path}")
+        # Unbuffered so the HTTP client reads straight from the OS file. Only the
+        # open runs in a thread; httpx still reads the file on the event loop.
+        f = await asyncio.to_thread(open, doc_path, "rb", buffering=0)
+        with f:
+            upload_id = await client.upload(os.path.basename(doc_path), f)
+        print(f"   ✅ Uploaded: {upload_id}")
+        return upload_id
 
 
-def main():
+async def main():
     """Create collections for the credit renewal workflow."""
 
     # Initialize h2oGPTe client
-    client = H2OGPTE(
+    client = H2OGPTEAsync(
         address=os.getenv("H2OGPTE_URL", "https://h2ogpte.genai.h2o.ai"),
         api_key=os.getenv("H2OGPTE_API_KEY")
     )
@@ -35,7 +61,8 @@ def main():
         )
 
     print("🔍 Checking existing collections...")
-    existing_collections = {c.name: c.id for c in client.list_recent_collections(0, 1000)}
+    existing_collections = {c.name: c.id for c in await client.list_recent_collections(0, 1000)}
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
 
     # Define collections to create for the credit renewal workflow
     collections_to_create = {
@@ -67,6 +94,18 @@ def main():
         }
     }
 
+    # List every reference directory once instead of stat-ing each document
+    doc_dirs = {
+        os.path.dirname(doc_path)
+        for config in collections_to_create.values()
+        for doc_path in config["documents"]
+    }
+    existing_paths = set()
+    for doc_dir in doc_dirs:
+        if os.path.isdir(doc_dir):
+            with os.scandir(doc_dir) as entries:
+                existing_paths.update(entry.path for entry in entries if entry.is_file())
+
     created_collections = {}
 
     for collection_name, config in collections_to_create.items():
@@ -81,29 +120,27 @@ def main():
 
         # Create new collection
         try:
-            collection_id = client.create_collection(
+            collection_id = await client.create_collection(
                 name=collection_name,
                 description=config["description"]
             )
             print(f"   ✅ Created collection: {collection_id}")
 
-            # Upload and ingest documents
-            uploaded_files = []
-            for doc_path in config["documents"]:
-                if os.path.exists(doc_path):
-                    print(f"   📄 Uploading: {doc_path}")
-                    # Upload the file first
-                    with open(doc_path, "rb") as f:
-                        upload_id = client.upload(os.path.basename(doc_path), f)
-                        uploaded_files.append(upload_id)
-                        print(f"   ✅ Uploaded: {upload_id}")
-                else:
-                    print(f"   ⚠️  File not found: {doc_path}")
+            # Upload documents concurrently, then ingest them together;
+            # one failed upload cancels the rest of the collection's uploads
+            upload_tasks = []
+            async with asyncio.TaskGroup() as task_group:
+                for doc_path in config["documents"]:
+                    if doc_path in existing_paths:
+                        upload_tasks.append(task_group.create_task(_upload_one(client, semaphore, doc_path)))
+                    else:
+                        print(f"   ⚠️  File not found: {doc_path}")
+            uploaded_files = [task.result() for task in upload_tasks]
 
             # Ingest all uploaded files into the collection
             if uploaded_files:
                 print(f"   📄 Ingesting {len(uploaded_files)} files into collection...")
-                client.ingest_uploads(
+                await client.ingest_uploads(
                     collection_id=collection_id,
                     upload_ids=uploaded_files
                 )
@@ -111,6 +148,9 @@ def main():
 
             created_collections[collection_name] = collection_id
 
+        except ExceptionGroup as eg:
+            for e in eg.exceptions:
+                print(f"   ❌ Error creating {collection_name}: {str(e)}")
         except Exception as e:
             print(f"   ❌ Error creating {collection_name}: {str(e)}")
 
@@ -119,25 +159,18 @@ def main():
     if os.path.exists(env_file_path):
         print("\n📝 Updating .env file with new collection IDs...")
 
-        # Read current .env file
-        with open(env_file_path, 'r') as f:
-            lines = f.readlines()
-
-        # Update collection IDs in the file
-        updated_lines = []
-        for line in lines:
-            if line.startswith("POLICY_COLLECTION_ID="):
-                updated_lines.append(f"POLICY_COLLECTION_ID={created_collections.get('Policy Collection', '')}\n")
-            elif line.startswith("ENTITY_COLLECTION_ID="):
-                updated_lines.append(f"ENTITY_COLLECTION_ID={created_collections.get('Entity Collection', '')}\n")
-            elif line.startswith("MARKET_COLLECTION_ID="):
-                updated_lines.append(f"MARKET_COLLECTION_ID={created_collections.get('Market Collection', '')}\n")
-            else:
-                updated_lines.append(line)
-
-        # Write updated .env file
-        with open(env_file_path, 'w') as f:
-            f.writelines(updated_lines)
+        # Rewrite the collection ID lines in a single pass
+        env_file = Path(env_file_path)
+        collection_ids = {
+            "POLICY_COLLECTION_ID": created_collections.get('Policy Collection', ''),
+            "ENTITY_COLLECTION_ID": created_collections.get('Entity Collection', ''),
+            "MARKET_COLLECTION_ID": created_collections.get('Market Collection', '')
+        }
+        env_text = ENV_COLLECTION_ID_PATTERN.sub(
+            lambda m: f"{m.group(1)}={collection_ids[m.group(1)]}",
+            env_file.read_text()
+        )
+        env_file.write_text(env_text)
 
         print("   ✅ Updated .env file with new collection IDs")
     else:
@@ -153,4 +186,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
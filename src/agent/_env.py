@@ -0,0 +1,10 @@
+"""Shared environment loading for the credit renewal workflow."""
+from functools import cache
+
+from dotenv import load_dotenv
+
+
+@cache
+def ensure_env() -> bool:
+    """Load the .env file once per process."""
+    return load_dotenv()
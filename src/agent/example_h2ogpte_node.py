@@ -1,19 +1,14 @@
 """Example h2oGPTe node."""
-import os
-
-from dotenv import load_dotenv
-from h2ogpte import H2OGPTEAsync
+from src.agent._env import ensure_env
+from src.agent.h2ogpte_nodes import get_h2ogpte_client
 
 # Load environment variables
-load_dotenv()
+ensure_env()
 
 
 async def example_h2ogpte_node(state) -> dict:
     """Example h2oGPTe node."""
-    client = await H2OGPTEAsync(
-        address=os.getenv('H2OGPTE_URL', 'https://h2ogpte.genai.h2o.ai'),  # default to freemium
-        api_key=os.getenv('H2OGPTE_API_KEY')
-    )
+    client = await get_h2ogpte_client()
 
     chat_session_id = await client.create_chat_session()
 
@@ -1,17 +1,27 @@
 """LangGraph workflow for credit renewal processing with RAG and HITL."""
+import asyncio
+from dataclasses import dataclass
 from typing import TypedDict
 
-from langgraph.checkpoint.memory import MemorySaver
+import aiosqlite
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from langgraph.graph import StateGraph
 from langgraph.types import interrupt
 
 from src.agent.h2ogpte_nodes import (
+    close_h2ogpte_sessions,
+    decompress_pack,
+    rag_all,
     rag_entity,
     rag_market,
     rag_policy,
     synthesize_recommendation,
+    warm_up_h2ogpte_sessions,
 )
 
+# On-disk checkpoint store for HITL runs
+CHECKPOINT_DB_PATH = "checkpoints.db"
+
 
 class CreditRenewalInput(TypedDict):
     """Input schema for the credit renewal workflow - only what users need to provide."""
@@ -19,122 +29,148 @@ class CreditRenewalInput(TypedDict):
     sector: str
 
 
-class OverallState(TypedDict):
-    """Internal state schema for the credit renewal workflow."""
-    borrower_id: str
-    sector: str
-    policy_query: str
-    entity_query: str
-    market_query: str
-    policy_pack: str
-    entity_pack: str
-    market_pack: str
-    credit_memo: str
-    approved_memo: str
-    rerun_policy: bool
-    rerun_entity: bool
-    rerun_market: bool
+@dataclass(slots=True)
+class OverallState:
+    """Internal state schema for the credit renewal workflow.
+
+    ``policy_pack``, ``entity_pack`` and ``market_pack`` hold zstd-compressed
+    UTF-8 bytes, so they show as opaque bytes in run results and as base64
+    strings in the Studio state view; read them with ``decompress_pack``, which
+    also accepts the base64 or plain-text string an edited state hands back.
+    """
+    borrower_id: str = ""
+    sector: str = ""
+    policy_query: str = ""
+    entity_query: str = ""
+    market_query: str = ""
+    policy_pack: bytes = b""
+    entity_pack: bytes = b""
+    market_pack: bytes = b""
+    credit_memo: str = ""
+    approved_memo: str = ""
+    # Set on HITL rejection so the rerun bypasses the cached RAG reply
+    rerun_policy: bool = False
+    rerun_entity: bool = False
+    rerun_market: bool = False
     # Individual RAG acceptance fields
-    accept_policy: bool
-    accept_entity: bool
-    accept_market: bool
+    accept_policy: bool = False
+    accept_entity: bool = False
+    accept_market: bool = False
     # Final approval field
-    accept_synthesis: bool
+    accept_synthesis: bool = False
 
 
-async def ingest_renewal_alert(state: OverallState) -> OverallState:
+async def ingest_renewal_alert(state: OverallState) -> dict:
     """Ingest node: receives renewal trigger and sets up state."""
     # Parse input and set up queries for RAG retrieval
-    borrower_id = state.get('borrower_id', 'TechManufacture Inc')
-    sector = state.get('sector', 'Advanced Manufacturing')
+    borrower_id = state.borrower_id or 'TechManufacture Inc'
+    sector = state.sector or 'Advanced Manufacturing'
 
-    state['policy_query'] = f"Credit policy and underwriting guidelines for {borrower_id} in {sector} sector"
-    state['entity_query'] = f"Financial data, credit history, and risk profile for {borrower_id}"
-    state['market_query'] = f"Market conditions, sector analysis, and economic indicators for {sector} sector"
+    # Open the h2oGPTe connection and RAG sessions before the RAG nodes need them
+    await warm_up_h2ogpte_sessions()
 
-    return state
+    return {
+        "policy_query": f"Credit policy and underwriting guidelines for {borrower_id} in {sector} sector",
+        "entity_query": f"Financial data, credit history, and risk profile for {borrower_id}",
+        "market_query": f"Market conditions, sector analysis, and economic indicators for {sector} sector",
+        # A thread is reused per borrower, so clear results from any earlier run
+        "policy_pack": b"",
+        "entity_pack": b"",
+        "market_pack": b"",
+        "credit_memo": "",
+        "accept_policy": False,
+        "accept_entity": False,
+        "accept_market": False,
+        "accept_synthesis": False
+    }
 
 
-def hitl_policy_review(state: OverallState) -> OverallState:
+def hitl_policy_review(state: OverallState) -> dict:
     """HITL node: review policy RAG output."""
+    policy_pack = decompress_pack(state.policy_pack) or 'Not available'
     policy_summary = f"""
 POLICY RAG REVIEW:
 
 📋 POLICY ANALYSIS:
-{state.get('policy_pack', 'Not available')}
+{policy_pack}
 
 Accept response?
 """
 
     # Use interrupt with the policy pack for human review
     accept_policy = interrupt({
-        "policy_pack": state.get('policy_pack', 'Not available'),
+        "policy_pack": policy_pack,
         "message": policy_summary
     })
 
     return {
-        "accept_policy": accept_policy
+        "accept_policy": accept_policy,
+        "rerun_policy": not accept_policy
     }
 
 
-def hitl_entity_review(state: OverallState) -> OverallState:
+def hitl_entity_review(state: OverallState) -> dict:
     """HITL node: review entity RAG output."""
+    entity_pack = decompress_pack(state.entity_pack) or 'Not available'
     entity_summary = f"""
 ENTITY RAG REVIEW:
 
 🏢 ENTITY ANALYSIS:
-{state.get('entity_pack', 'Not available')}
+{entity_pack}
 
 Accept response?
 """
 
     # Use interrupt with the entity pack for human review
     accept_entity = interrupt({
-        "entity_pack": state.get('entity_pack', 'Not available'),
+        "entity_pack": entity_pack,
         "message": entity_summary
     })
 
     return {
-        "accept_entity": accept_entity
+        "accept_entity": accept_entity,
+        "rerun_entity": not accept_entity
     }
 
 
-def hitl_market_review(state: OverallState) -> OverallState:
+def hitl_market_review(state: OverallState) -> dict:
     """HITL node: review market RAG output."""
+    market_pack = decompress_pack(state.market_pack) or 'Not available'
     market_summary = f"""
 MARKET RAG REVIEW:
 
 📈 MARKET ANALYSIS:
-{state.get('market_pack', 'Not available')}
+{market_pack}
 
 Accept response?
 """
 
     # Use interrupt with the market pack for human review
     accept_market = interrupt({
-        "market_pack": state.get('market_pack', 'Not available'),
+        "market_pack": market_pack,
         "message": market_summary
     })
 
     return {
-        "accept_market": accept_market
+        "accept_market": accept_market,
+        "rerun_market": not accept_market
     }
 
 
-def hitl_final_approval(state: OverallState) -> OverallState:
+def hitl_final_approval(state: OverallState) -> dict:
     """HITL node: final approval of synthesized memo."""
     approval_summary = f"""
 FINAL APPROVAL REQUIRED - CREDIT RENEWAL MEMO:
 
 📄 CREDIT MEMO:
-{state.get('credit_memo', 'Not available')}
+{state.credit_memo or 'Not available'}
 
 Accept response?
 """
 
     # Use interrupt with the credit memo for human review
     accept_synthesis = interrupt({
-        "credit_memo": state.get('credit_memo', 'Not available'),
+        "credit_memo": state.credit_memo or 'Not available',
         "message": approval_summary
     })
 
@@ -143,37 +179,47 @@ Accept response?
     }
 
 
-def should_rerun_policy(state: OverallState) -> bool:
-    """Check if policy RAG should be rerun."""
-    # If not accepted, then rerun
-    return not state.get('accept_policy', False)
+# Routing tables for the conditional edges, built once at import
+_POLICY_ROUTE = {"RAG_Policy": "RAG_Policy", "Synthesize": "Synthesize"}
+_ENTITY_ROUTE = {"RAG_Entity": "RAG_Entity", "Synthesize": "Synthesize"}
+_MARKET_ROUTE = {"RAG_Market": "RAG_Market", "Synthesize": "Synthesize"}
+_FINAL_ROUTE = {"Synthesize": "Synthesize", "__end__": "__end__"}
 
 
-def should_rerun_entity(state: OverallState) -> bool:
-    """Check if entity RAG should be rerun."""
-    # If not accepted, then rerun
-    return not state.get('accept_entity', False)
+def _route_policy(state: OverallState) -> str:
+    """Route policy review: rerun RAG unless accepted."""
+    return "Synthesize" if state.accept_policy else "RAG_Policy"
 
 
-def should_rerun_market(state: OverallState) -> bool:
-    """Check if market RAG should be rerun."""
-    # If not accepted, then rerun
-    return not state.get('accept_market', False)
+def _route_entity(state: OverallState) -> str:
+    """Route entity review: rerun RAG unless accepted."""
+    return "Synthesize" if state.accept_entity else "RAG_Entity"
+
+
+def _route_market(state: OverallState) -> str:
+    """Route market review: rerun RAG unless accepted."""
+    return "Synthesize" if state.accept_market else "RAG_Market"
+
+
+def _route_final(state: OverallState) -> str:
+    """Route final approval: redo synthesis unless accepted."""
+    return "__end__" if state.accept_synthesis else "Synthesize"
 
 
 def should_synthesize(state: OverallState) -> bool:
     """Check if all RAGs are complete and ready for synthesis."""
     # All RAGs must be accepted to proceed to synthesis
     return all([
-        state.get('accept_policy', False),
-        state.get('accept_entity', False),
-        state.get('accept_market', False)
+        state.accept_policy,
+        state.accept_entity,
+        state.accept_market
     ])
 
 
 # Create the graph with input schema
 graph = StateGraph(OverallState, input_schema=CreditRenewalInput)
 graph.add_node("Ingest", ingest_renewal_alert)
+graph.add_node("RAG_All", rag_all)
 graph.add_node("RAG_Policy", rag_policy)
 graph.add_node("RAG_Entity", rag_entity)
 graph.add_node("RAG_Market", rag_market)
@@ -186,101 +232,88 @@ graph.add_node("HITL_Final", hitl_final_approval)
 # Set entrypoint
 graph.set_entry_point("Ingest")
 
-# Ingest → three RAGs in parallel
-graph.add_edge("Ingest", "RAG_Policy")
-graph.add_edge("Ingest", "RAG_Entity")
-graph.add_edge("Ingest", "RAG_Market")
+# Ingest → all three RAGs queried concurrently in a single node
+graph.add_edge("Ingest", "RAG_All")
+
+# Fused RAG → each individual HITL review
+graph.add_edge("RAG_All", "HITL_Policy")
+graph.add_edge("RAG_All", "HITL_Entity")
+graph.add_edge("RAG_All", "HITL_Market")
 
-# Each RAG → its individual HITL review
+# Each rerun RAG → its individual HITL review
 graph.add_edge("RAG_Policy", "HITL_Policy")
 graph.add_edge("RAG_Entity", "HITL_Entity")
 graph.add_edge("RAG_Market", "HITL_Market")
 
 # Each HITL → conditional routing (rerun RAG or proceed to synthesis)
-graph.add_conditional_edges(
-    "HITL_Policy",
-    lambda state: "RAG_Policy" if should_rerun_policy(state) else "Synthesize",
-    {
-        "RAG_Policy": "RAG_Policy",
-        "Synthesize": "Synthesize"
-    }
-)
-
-graph.add_conditional_edges(
-    "HITL_Entity",
-    lambda state: "RAG_Entity" if should_rerun_entity(state) else "Synthesize",
-    {
-        "RAG_Entity": "RAG_Entity",
-        "Synthesize": "Synthesize"
-    }
-)
-
-graph.add_conditional_edges(
-    "HITL_Market",
-    lambda state: "RAG_Market" if should_rerun_market(state) else "Synthesize",
-    {
-        "RAG_Market": "RAG_Market",
-        "Synthesize": "Synthesize"
-    }
-)
+graph.add_conditional_edges("HITL_Policy", _route_policy, _POLICY_ROUTE)
+graph.add_conditional_edges("HITL_Entity", _route_entity, _ENTITY_ROUTE)
+graph.add_conditional_edges("HITL_Market", _route_market, _MARKET_ROUTE)
 
 # Synthesis → Final HITL
 graph.add_edge("Synthesize", "HITL_Final")
 
 # Final HITL → conditional routing (back to synthesis if not accepted)
-graph.add_conditional_edges(
-    "HITL_Final",
-    lambda state: "Synthesize" if not state.get('accept_synthesis', False) else "__end__",
-    {
-        "Synthesize": "Synthesize",
-        "__end__": "__end__"
-    }
-)
+graph.add_conditional_edges("HITL_Final", _route_final, _FINAL_ROUTE)
+
+
+async def create_checkpointer() -> AsyncSqliteSaver:
+    """Create a SQLite checkpointer tuned for frequent small writes."""
+    conn = await aiosqlite.connect(CHECKPOINT_DB_PATH)
+    # WAL + NORMAL sync keeps checkpoint writes from waiting on fsync
+    await conn.execute("PRAGMA journal_mode=WAL")
+    await conn.execute("PRAGMA synchronous=NORMAL")
+    return AsyncSqliteSaver(conn)
 
 
-def run_credit_renewal(borrower_id: str, sector: str):
-    """Simplified interface for running credit renewal workflow."""
+async def run_credit_renewal(borrower_id: str, sector: str):
+    """Simplified interface for running credit renewal workflow.
+
+    The returned graph keeps its checkpointer connection open so the run can be
+    resumed; callers close ``compiled_graph.checkpointer.conn`` when done.
+    """
     # Create checkpointer
-    checkpointer = MemorySaver()
+    checkpointer = await create_checkpointer()
 
     # Compile the graph with checkpointer
     compiled_graph = graph.compile(checkpointer=checkpointer)
 
-    # Create input with defaults for internal fields
+    # Internal fields are populated from the OverallState defaults
     input_data = {
         "borrower_id": borrower_id,
-        "sector": sector,
-        # These will be populated by the workflow
-        "policy_query": "",
-        "entity_query": "",
-        "market_query": "",
-        "policy_pack": "",
-        "entity_pack": "",
-        "market_pack": "",
-        "credit_memo": "",
-        "approved_memo": "",
-        "rerun_policy": False,
-        "rerun_entity": False,
-        "rerun_market": False,
-        "accept_policy": False,
-        "accept_entity": False,
-        "accept_market": False,
-        "accept_synthesis": False
+        "sector": sector
     }
 
     # Run the graph until interrupt
     config = {"configurable": {"thread_id": f"credit_renewal_{borrower_id}"}}
-    result = compiled_graph.invoke(input_data, config=config)
+    try:
+        result = await compiled_graph.ainvoke(input_data, config=config)
+    except BaseException:
+        # aiosqlite's worker thread keeps the interpreter alive until closed
+        await checkpointer.conn.close()
+        raise
     return result, compiled_graph, config
 
 
-def main():
+async def _main():
     """Run example input and execution."""
     # Simple demo - just provide borrower and sector
-    result, compiled_graph, config = run_credit_renewal(
-        borrower_id="TechManufacture Inc",
-        sector="Advanced Manufacturing"
-    )
+    compiled_graph = None
+    try:
+        _result, compiled_graph, _config = await run_credit_renewal(
+            borrower_id="TechManufacture Inc",
+            sector="Advanced Manufacturing"
+        )
+    finally:
+        # Close the checkpointer and shared h2oGPTe sessions before the event loop shuts down
+        if compiled_graph is not None:
+            await compiled_graph.checkpointer.conn.close()
+        await close_h2ogpte_sessions()
+
+
+def main():
+    """Run example input and execution."""
+    asyncio.run(_main())
 
 
 if __name__ == "__main__":
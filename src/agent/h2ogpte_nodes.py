@@ -1,147 +1,414 @@
 """h2oGPTe specific nodes for the credit renewal workflow."""
+import asyncio
+import base64
+import binascii
+import logging
 import os
+import string
+import time
+from collections import OrderedDict
+from collections.abc import Callable
 
-from dotenv import load_dotenv
+import zstandard
 from h2ogpte import H2OGPTEAsync
+from h2ogpte.errors import HTTPError, InternalServerError
+from h2ogpte.session_async import SessionAsync
+from h2ogpte.types import ChatMessage
+from langgraph.types import StreamWriter
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+from websockets.exceptions import ConnectionClosed
+
+from src.agent._env import ensure_env
 
 # Load environment variables
-load_dotenv()
+ensure_env()
+
+logger = logging.getLogger(__name__)
+
+
+def _require_env(name: str) -> str:
+    """Read a required environment variable, failing fast if it is missing."""
+    value = os.getenv(name)
+    if not value:
+        raise ValueError(
+            f"{name} environment variable not set. "
+            "Please check the README for setup instructions and ensure your .env file is configured correctly."
+        )
+    return value
+
+
+# Collection IDs for RAG queries, resolved once at import
+POLICY_COLLECTION_ID = _require_env('POLICY_COLLECTION_ID')
+ENTITY_COLLECTION_ID = _require_env('ENTITY_COLLECTION_ID')
+MARKET_COLLECTION_ID = _require_env('MARKET_COLLECTION_ID')
+
+_SYNTH_TEMPLATE = string.Template("""
+    Based on the following information, create a comprehensive credit renewal memo:
+
+    Policy Context:
+    $policy_pack
+
+    Entity Analysis:
+    $entity_pack
+
+    Market Analysis:
+    $market_pack
+
+    Please provide:
+    1. Credit rating recommendation
+    2. Key covenants and conditions
+    3. Pricing recommendations
+    4. Risk factors and mitigants
+    5. Citations and supporting evidence
+
+    Format as a professional credit memo.
+    """)
+
+# Packs are kept zstd-compressed in state to shrink checkpoints
+_PACK_COMPRESSION_LEVEL = 3
+
+
+def compress_pack(text: str) -> bytes:
+    """Compress a RAG pack for storage in workflow state."""
+    return zstandard.compress(text.encode(), _PACK_COMPRESSION_LEVEL)
+
+
+def decompress_pack(data: bytes | str) -> str:
+    """Decompress a RAG pack stored in workflow state."""
+    # One-shot call: HITL nodes run in executor threads and
+    # zstandard compressor/decompressor objects are not thread-safe
+    if not data:
+        return ""
+    if isinstance(data, str):
+        # Studio and API clients see bytes state as base64, so edited or forked
+        # state comes back as a string; anything else is a hand-written pack
+        try:
+            return zstandard.decompress(base64.b64decode(data, validate=True)).decode()
+        except (binascii.Error, zstandard.ZstdError, UnicodeDecodeError):
+            return data
+    return zstandard.decompress(data).decode()
+
+
+# Shared client so every node reuses the same connection pool
+_client: H2OGPTEAsync | None = None
+_client_lock = asyncio.Lock()
+
+# RAG replies keyed by (collection_id, query) so identical reruns skip the round-trip.
+# Entries expire so re-ingested collections are picked up, least recently used first out.
+_RAG_CACHE_MAXSIZE = 256
+_RAG_CACHE_TTL = 3600  # seconds
+_rag_cache: OrderedDict[tuple[str, str], tuple[float, str]] = OrderedDict()
+
+# Chat session IDs per collection (None for plain LLM queries) not running a
+# query; each query checks one out, so concurrent runs don't wait on each other
+_idle_session_ids: dict[str | None, list[str]] = {}
+# Connected websockets by chat session ID
+_sessions: dict[str, SessionAsync] = {}
+_session_locks: dict[str | None, asyncio.Lock] = {}
+
+# Idle websockets kept open per collection; busier bursts reconnect on demand
+_SESSION_POOL_SIZE = 4
+
+# Failures that leave the websocket unusable; HTTP and session errors do not.
+# A cancelled query may still have its reply in flight on the websocket.
+_STALE_CONNECTION_ERRORS = (ConnectionClosed, OSError, asyncio.CancelledError)
 
 
 async def get_h2ogpte_client() -> H2OGPTEAsync:
-    """Get configured h2oGPTE async client."""
-    return H2OGPTEAsync(
-        address=os.getenv('H2OGPTE_URL', 'https://h2ogpte.genai.h2o.ai'),  # default to freemium
-        api_key=os.getenv('H2OGPTE_API_KEY')
-    )
+    """Get the shared, lazily-created h2oGPTE async client."""
+    global _client
+    if _client is None:
+        async with _client_lock:
+            if _client is None:
+                _client = H2OGPTEAsync(
+                    address=os.getenv('H2OGPTE_URL', 'https://h2ogpte.genai.h2o.ai'),  # default to freemium
+                    api_key=os.getenv('H2OGPTE_API_KEY')
+                )
+    return _client
 
 
-async def query_h2ogpte_rag(query: str, collection_id: str) -> str:
-    """Query h2oGPTE RAG with given collection ID."""
-    client = await get_h2ogpte_client()
-    chat_session_id = await client.create_chat_session(collection_id=collection_id)
+async def _connect_session(chat_session_id: str) -> SessionAsync:
+    """Get the websocket for a chat session, connecting it if needed."""
+    if chat_session_id not in _sessions:
+        client = await get_h2ogpte_client()
+        _sessions[chat_session_id] = await client.connect(chat_session_id).__aenter__()
+    return _sessions[chat_session_id]
 
-    async with client.connect(chat_session_id) as session:
-        reply = await session.query(
-            query,
-            timeout=3600,
-            llm_args={
-                "use_agent": False,
-                "agent_accuracy": "standard"
-            }
-        )
-    return reply.content
+
+async def _checkout_session(collection_id: str | None) -> tuple[str, SessionAsync]:
+    """Take an idle chat session for a collection, creating one if all are busy."""
+    idle = _idle_session_ids.setdefault(collection_id, [])
+    if idle:
+        chat_session_id = idle.pop()
+    else:
+        client = await get_h2ogpte_client()
+        chat_session_id = await client.create_chat_session(collection_id=collection_id)
+    try:
+        return chat_session_id, await _connect_session(chat_session_id)
+    except BaseException:
+        idle.append(chat_session_id)
+        raise
+
+
+async def _release_session(collection_id: str | None, chat_session_id: str) -> None:
+    """Return a chat session to the idle pool, closing its websocket if the pool is full."""
+    idle = _idle_session_ids.setdefault(collection_id, [])
+    if sum(idle_id in _sessions for idle_id in idle) < _SESSION_POOL_SIZE:
+        idle.append(chat_session_id)
+    else:
+        # Disconnected sessions go to the front so connected ones are reused first
+        idle.insert(0, chat_session_id)
+        await _disconnect_session(chat_session_id)
+
+
+async def _disconnect_session(chat_session_id: str) -> None:
+    """Close the websocket for a chat session, keeping the chat session itself."""
+    session = _sessions.pop(chat_session_id, None)
+    if session is None:
+        return
+    try:
+        await session.__aexit__(None, None, None)
+    except Exception as e:
+        logger.warning("Failed to close h2oGPTe chat session %s: %s", chat_session_id, e)
 
 
-async def query_h2ogpte_llm(prompt: str) -> str:
-    """Query h2oGPTE LLM without RAG."""
-    client = await get_h2ogpte_client()
-    chat_session_id = await client.create_chat_session()
+async def _query_session(
+    message: str,
+    collection_id: str | None,
+    callback: Callable[[ChatMessage], None] | None = None
+) -> str:
+    """Send a query on an idle chat session for a collection.
 
-    async with client.connect(chat_session_id) as session:
+    Sessions are reused across workflow threads, so chat history is turned off
+    to keep earlier borrowers' questions and answers out of each prompt.
+    """
+    chat_session_id, session = await _checkout_session(collection_id)
+    try:
         reply = await session.query(
-            prompt,
+            message,
             timeout=3600,
+            include_chat_history="off",
             llm_args={
                 "use_agent": False,
                 "agent_accuracy": "standard"
-            }
+            },
+            callback=callback
         )
+    except _STALE_CONNECTION_ERRORS:
+        # Reconnect to the same chat session on its next checkout
+        await _disconnect_session(chat_session_id)
+        raise
+    finally:
+        await _release_session(collection_id, chat_session_id)
     return reply.content
 
 
+def _has_idle_session(collection_id: str | None) -> bool:
+    """Check if a connected chat session is waiting for the collection's next query."""
+    return any(idle_id in _sessions for idle_id in _idle_session_ids.get(collection_id, ()))
+
+
+async def _ensure_session(collection_id: str | None) -> None:
+    """Open a chat session for a collection ahead of its first query."""
+    if _has_idle_session(collection_id):
+        return
+
+    # One warm-up per collection at a time so concurrent Ingests share a session
+    async with _session_locks.setdefault(collection_id, asyncio.Lock()):
+        if _has_idle_session(collection_id):
+            return
+        chat_session_id, _ = await _checkout_session(collection_id)
+        await _release_session(collection_id, chat_session_id)
+
+
+async def warm_up_h2ogpte_sessions() -> None:
+    """Connect the client and open the RAG collection sessions concurrently."""
+    collection_ids = (POLICY_COLLECTION_ID, ENTITY_COLLECTION_ID, MARKET_COLLECTION_ID)
+    results = await asyncio.gather(
+        *(_ensure_session(collection_id) for collection_id in collection_ids),
+        return_exceptions=True
+    )
+    # Failures are left for the RAG nodes to surface on their own query
+    for collection_id, result in zip(collection_ids, results):
+        if isinstance(result, BaseException):
+            logger.warning("Failed to warm up h2oGPTe session for collection %s: %s", collection_id, result)
+
+
+async def close_h2ogpte_sessions() -> None:
+    """Disconnect all cached chat sessions."""
+    for chat_session_id in list(_sessions):
+        await _disconnect_session(chat_session_id)
+
+
+def _is_transient(error: BaseException) -> bool:
+    """Check if an h2oGPTe failure is worth retrying (rate limits, 5xx, network)."""
+    # Timeouts are not retried: a single attempt may already run for an hour
+    if isinstance(error, HTTPError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, (InternalServerError, ConnectionError))
+
+
+# Back off and retry transient failures instead of surfacing them to HITL review
+_retry_transient = retry(
+    retry=retry_if_exception(_is_transient),
+    wait=wait_exponential_jitter(initial=1, max=60),
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+
+
+def invalidate_rag_cache(collection_id: str, query: str) -> None:
+    """Drop a cached RAG reply so the next query hits h2oGPTE again."""
+    _rag_cache.pop((collection_id, query), None)
+
+
+@_retry_transient
+async def query_h2ogpte_rag(query: str, collection_id: str) -> str:
+    """Query h2oGPTE RAG with given collection ID, reusing cached replies."""
+    key = (collection_id, query)
+    cached = _rag_cache.get(key)
+    if cached is not None:
+        cached_at, content = cached
+        if time.monotonic() - cached_at < _RAG_CACHE_TTL:
+            _rag_cache.move_to_end(key)
+            return content
+        _rag_cache.pop(key, None)
+
+    content = await _query_session(query, collection_id)
+    _rag_cache[key] = (time.monotonic(), content)
+    _rag_cache.move_to_end(key)
+    while len(_rag_cache) > _RAG_CACHE_MAXSIZE:
+        _rag_cache.popitem(last=False)
+    return content
+
+
+async def query_h2ogpte_llm(prompt: str, callback: Callable[[ChatMessage], None] | None = None) -> str:
+    """Query h2oGPTE LLM without RAG, passing partial replies to ``callback`` as they stream in.
+
+    Not retried here: callers own the streamed state and must reset it per attempt.
+    """
+    return await _query_session(prompt, None, callback=callback)
+
+
 async def rag_policy(state) -> dict:
     """RAG-Policy node: retrieves policy context."""
-    policy_collection_id = os.getenv('POLICY_COLLECTION_ID')
-    if not policy_collection_id:
-        raise ValueError(
-            "POLICY_COLLECTION_ID environment variable not set. "
-            "Please check the README for setup instructions and ensure your .env file is configured correctly."
-        )
+    # Already accepted; skip re-querying when a superstep is replayed
+    if state.accept_policy and state.policy_pack:
+        return {}
+
+    # A rejected pack must not be served again from the cache
+    if state.rerun_policy:
+        invalidate_rag_cache(POLICY_COLLECTION_ID, state.policy_query)
 
     try:
-        policy_content = await query_h2ogpte_rag(state['policy_query'], policy_collection_id)
+        policy_content = await query_h2ogpte_rag(state.policy_query, POLICY_COLLECTION_ID)
         return {
-            "policy_pack": f"Policy Analysis:\n{policy_content}",
-            "accept_policy": False  # Reset acceptance when rerunning
+            "policy_pack": compress_pack(f"Policy Analysis:\n{policy_content}"),
+            "accept_policy": False,  # Reset acceptance when rerunning
+            "rerun_policy": False
         }
     except Exception as e:
         return {
-            "policy_pack": f"Policy retrieval failed: {str(e)}",
-            "accept_policy": False  # Reset acceptance when rerunning
+            "policy_pack": compress_pack(f"Policy retrieval failed: {str(e)}"),
+            "accept_policy": False,  # Reset acceptance when rerunning
+            "rerun_policy": False
         }
 
 
 async def rag_entity(state) -> dict:
     """RAG-Entity node: retrieves borrower/entity data."""
-    entity_collection_id = os.getenv('ENTITY_COLLECTION_ID')
-    if not entity_collection_id:
-        raise ValueError(
-            "ENTITY_COLLECTION_ID environment variable not set. "
-            "Please check the README for setup instructions and ensure your .env file is configured correctly."
-        )
+    # Already accepted; skip re-querying when a superstep is replayed
+    if state.accept_entity and state.entity_pack:
+        return {}
+
+    # A rejected pack must not be served again from the cache
+    if state.rerun_entity:
+        invalidate_rag_cache(ENTITY_COLLECTION_ID, state.entity_query)
 
     try:
-        entity_content = await query_h2ogpte_rag(state['entity_query'], entity_collection_id)
+        entity_content = await query_h2ogpte_rag(state.entity_query, ENTITY_COLLECTION_ID)
         return {
-            "entity_pack": f"Entity Analysis:\n{entity_content}",
-            "accept_entity": False  # Reset acceptance when rerunning
+            "entity_pack": compress_pack(f"Entity Analysis:\n{entity_content}"),
+            "accept_entity": False,  # Reset acceptance when rerunning
+            "rerun_entity": False
         }
     except Exception as e:
         return {
-            "entity_pack": f"Entity retrieval failed: {str(e)}",
-            "accept_entity": False  # Reset acceptance when rerunning
+            "entity_pack": compress_pack(f"Entity retrieval failed: {str(e)}"),
+            "accept_entity": False,  # Reset acceptance when rerunning
+            "rerun_entity": False
         }
 
 
 async def rag_market(state) -> dict:
     """RAG-Market node: retrieves market/sector data."""
-    market_collection_id = os.getenv('MARKET_COLLECTION_ID')
-    if not market_collection_id:
-        raise ValueError(
-            "MARKET_COLLECTION_ID environment variable not set. "
-            "Please check the README for setup instructions and ensure your .env file is configured correctly."
-        )
+    # Already accepted; skip re-querying when a superstep is replayed
+    if state.accept_market and state.market_pack:
+        return {}
+
+    # A rejected pack must not be served again from the cache
+    if state.rerun_market:
+        invalidate_rag_cache(MARKET_COLLECTION_ID, state.market_query)
 
     try:
-        market_content = await query_h2ogpte_rag(state['market_query'], market_collection_id)
+        market_content = await query_h2ogpte_rag(state.market_query, MARKET_COLLECTION_ID)
         return {
-            "market_pack": f"Market Analysis:\n{market_content}",
-            "accept_market": False  # Reset acceptance when rerunning
+            "market_pack": compress_pack(f"Market Analysis:\n{market_content}"),
+            "accept_market": False,  # Reset acceptance when rerunning
+            "rerun_market": False
         }
     except Exception as e:
         return {
-            "market_pack": f"Market retrieval failed: {str(e)}",
-            "accept_market": False  # Reset acceptance when rerunning
+            "market_pack": compress_pack(f"Market retrieval failed: {str(e)}"),
+            "accept_market": False,  # Reset acceptance when rerunning
+            "rerun_market": False
         }
 
 
-async def synthesize_recommendation(state) -> dict:
-    """Synthesis node: compiles packs, drafts memo."""
-    synthesis_prompt = f"""
-    Based on the following information, create a comprehensive credit renewal memo:
+async def rag_all(state) -> dict:
+    """RAG fan-out node: retrieves policy, entity and market context concurrently."""
+    packs = await asyncio.gather(
+        rag_policy(state),
+        rag_entity(state),
+        rag_market(state)
+    )
+    return {key: value for pack in packs for key, value in pack.items()}
 
-    Policy Context:
-    {state['policy_pack']}
 
-    Entity Analysis:
-    {state['entity_pack']}
+@_retry_transient
+async def _stream_memo(prompt: str, writer: StreamWriter) -> str:
+    """Draft the credit memo, streaming it through ``writer``; each attempt restarts the stream."""
+    partial_memo = ""
+    pending_delta = None
 
-    Market Analysis:
-    {state['market_pack']}
+    def stream_partial(message: ChatMessage) -> None:
+        nonlocal partial_memo, pending_delta
+        # Hold each message back by one: the last is the full reply, emitted on return
+        if pending_delta is not None:
+            partial_memo += pending_delta
+            writer({"credit_memo": partial_memo})
+        pending_delta = message.content
 
-    Please provide:
-    1. Credit rating recommendation
-    2. Key covenants and conditions
-    3. Pricing recommendations
-    4. Risk factors and mitigants
-    5. Citations and supporting evidence
+    credit_memo = await query_h2ogpte_llm(prompt, callback=stream_partial)
+    writer({"credit_memo": credit_memo})
+    return credit_memo
 
-    Format as a professional credit memo.
-    """
+
+async def synthesize_recommendation(state, writer: StreamWriter) -> dict:
+    """Synthesis node: compiles packs, drafts memo, streaming it as it is generated."""
+    synthesis_prompt = _SYNTH_TEMPLATE.substitute(
+        policy_pack=decompress_pack(state.policy_pack),
+        entity_pack=decompress_pack(state.entity_pack),
+        market_pack=decompress_pack(state.market_pack)
+    )
 
     try:
-        credit_memo = await query_h2ogpte_llm(synthesis_prompt)
+        credit_memo = await _stream_memo(synthesis_prompt, writer)
         return {"credit_memo": credit_memo}
     except Exception as e:
         return {"credit_memo": f"Synthesis failed: {str(e)}"}